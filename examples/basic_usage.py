@@ -6,6 +6,7 @@ Ejemplo de uso básico del sistema Mettler-Zebra
 import sys
 import os
 import time
+import socket
 
 # Agregar directorio src al path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
@@ -34,12 +35,13 @@ def ejemplo_basico():
     print("📊 Generando datos de prueba...")
     
     mensajes_prueba = [
-        "\x02WT,01250.5,g,S,T,PROD001,2024-08-25T10:30:15\x0341\r\n",
-        "\x02WT,00950.2,g,S,O,PROD002,2024-08-25T10:31:20\x0342\r\n", 
-        "\x02WT,01100.8,g,U,T,PROD003,2024-08-25T10:32:25\x0343\r\n"
+        "\x02WT,01250.5,g,S,T,PROD001,2024-08-25T10:30:15\x03C5\r\n",
+        "\x02WT,00950.2,g,S,O,PROD002,2024-08-25T10:31:20\x03C1\r\n", 
+        "\x02WT,01100.8,g,U,T,PROD003,2024-08-25T10:32:25\x03C9\r\n"
     ]
     
-    # 4. Procesar mensajes
+    # 4. Procesar mensajes y agrupar las etiquetas en un único envío
+    etiquetas = []
     for i, mensaje in enumerate(mensajes_prueba, 1):
         print(f"\n--- Procesando mensaje {i} ---")
         print(f"📨 Mettler: {mensaje.strip()}")
@@ -50,21 +52,30 @@ def ejemplo_basico():
         if zpl:
             print("✅ ZPL generado:")
             print(zpl[:100] + "..." if len(zpl) > 100 else zpl)
-            
-            # Enviar a Zebra
-            import socket
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect(("127.0.0.1", 9100))
-                sock.send(zpl.encode('utf-8'))
-                sock.close()
-                print("📤 Enviado a impresora Zebra")
-            except Exception as e:
-                print(f"❌ Error enviando: {e}")
+            etiquetas.append(zpl.encode('utf-8'))
         else:
             print("⚠️  No se generó ZPL")
+    
+    # Enviar todas las etiquetas a Zebra con una sola conexión
+    if etiquetas:
+        try:
+            with socket.create_connection(("127.0.0.1", 9100), timeout=5) as sock:
+                sock.sendall(b"".join(etiquetas))
+                # Fin de envío y leer las confirmaciones hasta que la impresora cierre
+                sock.shutdown(socket.SHUT_WR)
+                while sock.recv(4096):
+                    pass
+            print(f"\n📤 {len(etiquetas)} etiquetas enviadas a impresora Zebra")
+        except Exception as e:
+            print(f"❌ Error enviando: {e}")
         
-        time.sleep(2)
+        # Esperar a que la impresora termine los trabajos
+        limite = time.time() + 30
+        while time.time() < limite:
+            status = zebra.get_status()
+            if status['successful_jobs'] + status['failed_jobs'] >= len(etiquetas):
+                break
+            time.sleep(0.5)
     
     # 5. Mostrar estadísticas
     print(f"\n📊 Estado Zebra:")
@@ -107,7 +118,6 @@ def ejemplo_continuo():
         zpl = converter.convert_message(mensaje)
         if zpl:
             # Enviar a Zebra
-            import socket
             try:
                 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 sock.connect(("127.0.0.1", 9100))
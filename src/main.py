@@ -6,13 +6,21 @@ Simulador Mettler Toledo -> Convertidor -> Simulador Zebra
 
 import sys
 import time
+import socket
+import select
 import threading
 import logging
 import argparse
 import json
+from collections import deque
 from datetime import datetime
 from typing import Dict, Any
 
+try:
+    import orjson  # Opcional: lectura de configuración y volcado de estadísticas más rápidos
+except ImportError:
+    orjson = None
+
 # Importar componentes locales
 from mettler_simulator import MettlerToledoSimulatorNoSerial, MettlerToledoSimulator
 from protocol_converter import ProtocolConverter
@@ -22,6 +30,37 @@ from zebra_simulator import ZebraSimulator
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class _InterfaceMettlerMixin:
+    """Envía cada mensaje del simulador Mettler a la interfaz propietaria"""
+    
+    def __init__(self, owner: 'MettlerZebraInterface', **kwargs):
+        super().__init__(**kwargs)
+        self._owner = owner
+    
+    def send_weight_data(self):
+        data = self._generate_weight_data()
+        message = self._format_mettler_message(data)
+        
+        # Procesar mensaje con el convertidor de la interfaz
+        self._owner._process_mettler_message(message)
+        
+        # Mostrar mensaje original también
+        print(f"📊 METTLER: {message.strip()}")
+
+class _InterfaceMettler(_InterfaceMettlerMixin, MettlerToledoSimulatorNoSerial):
+    """Simulador Mettler sin puerto serial conectado a la interfaz"""
+
+class _InterfaceMettlerSerial(_InterfaceMettlerMixin, MettlerToledoSimulator):
+    """Simulador Mettler con puerto serial conectado a la interfaz"""
+
+def _json_dumps_indented(data: Any) -> str:
+    """Serializa a JSON indentado; orjson y json producen el mismo texto"""
+    if orjson is not None:
+        # Las fechas pasan por default=str igual que con json
+        return orjson.dumps(data, default=str,
+                            option=orjson.OPT_INDENT_2 | orjson.OPT_PASSTHROUGH_DATETIME).decode('utf-8')
+    return json.dumps(data, indent=2, default=str, ensure_ascii=False)
+
 class MettlerZebraInterface:
     """
     Interfaz principal que conecta la balanza Mettler Toledo con la impresora Zebra
@@ -35,8 +74,21 @@ class MettlerZebraInterface:
         self.zebra_simulator = None
         self.converter = None
         
+        # Conexión persistente con la impresora Zebra
+        self._zebra_sock = None
+        self._pending = bytearray()
+        self._pending_labels = 0
+        
+        # Cola productor (simulador) -> consumidor (hilo de envío)
+        self._send_q = deque()
+        self._send_event = threading.Event()
+        self._sender_thread = None
+        
         # Estado
         self.is_running = False
+        self._stop_event = threading.Event()
+        # Los contadores se actualizan desde el hilo del simulador y el de envío
+        self._stats_lock = threading.Lock()
         self.stats = {
             'messages_received': 0,
             'labels_printed': 0,
@@ -44,12 +96,18 @@ class MettlerZebraInterface:
             'start_time': None
         }
     
+    def _count(self, key: str, amount: int = 1):
+        """Incrementa un contador de estadísticas de forma segura entre hilos"""
+        with self._stats_lock:
+            self.stats[key] += amount
+    
     def _load_config(self, config_file: str) -> Dict[str, Any]:
         """Carga configuración principal"""
         if config_file:
             try:
-                with open(config_file, 'r') as f:
-                    return json.load(f)
+                with open(config_file, 'rb') as f:
+                    raw = f.read()
+                return orjson.loads(raw) if orjson is not None else json.loads(raw)
             except Exception as e:
                 logger.warning(f"No se pudo cargar configuración: {e}")
         
@@ -84,31 +142,39 @@ class MettlerZebraInterface:
             logger.info("🔄 Inicializando convertidor de protocolo...")
             self.converter = ProtocolConverter()
             
-            # Inicializar simulador Zebra
+            # Parámetros usados en cada mensaje
             zebra_config = self.config['zebra']
-            logger.info(f"🖨️  Inicializando simulador Zebra en {zebra_config['ip']}:{zebra_config['port']}")
+            self._zebra_ip = zebra_config['ip']
+            self._zebra_port = zebra_config['port']
+            self._template = self.config['converter'].get('template', 'standard')
+            
+            # Inicializar simulador Zebra
+            logger.info(f"🖨️  Inicializando simulador Zebra en {self._zebra_ip}:{self._zebra_port}")
             self.zebra_simulator = ZebraSimulator(
-                ip=zebra_config['ip'],
-                port=zebra_config['port']
+                ip=self._zebra_ip,
+                port=self._zebra_port
             )
             
             if not self.zebra_simulator.start_server():
                 raise Exception("No se pudo iniciar simulador Zebra")
             
+            # Abrir conexión persistente con la impresora
+            self._zebra_sock = self._connect_zebra()
+            
             # Inicializar simulador Mettler Toledo
             mettler_config = self.config['mettler']
             logger.info(f"⚖️  Inicializando simulador Mettler Toledo...")
             
             if mettler_config.get('simulation_mode', True):
-                self.mettler_simulator = MettlerToledoSimulatorNoSerial(
-                    port=mettler_config['port'],
-                    baudrate=mettler_config['baudrate']
-                )
+                simulator_class = _InterfaceMettler
             else:
-                self.mettler_simulator = MettlerToledoSimulator(
-                    port=mettler_config['port'],
-                    baudrate=mettler_config['baudrate']
-                )
+                simulator_class = _InterfaceMettlerSerial
+            
+            self.mettler_simulator = simulator_class(
+                self,
+                port=mettler_config['port'],
+                baudrate=mettler_config['baudrate']
+            )
             
             # Configurar intervalo de peso
             self.mettler_simulator.weight_interval = mettler_config.get('weight_interval', 3.0)
@@ -126,110 +192,184 @@ class MettlerZebraInterface:
             return False
         
         self.is_running = True
+        self._stop_event.clear()
         self.stats['start_time'] = datetime.now()
         
-        # Iniciar simulador Mettler Toledo con callback personalizado
-        self._start_mettler_with_callback()
+        # Hilo que envía las etiquetas a Zebra sin bloquear al simulador
+        self._sender_thread = threading.Thread(target=self._sender_loop, daemon=True)
+        self._sender_thread.start()
+        
+        # Iniciar simulador Mettler Toledo (envía cada mensaje a _process_mettler_message)
+        self.mettler_simulator.start_simulation()
         
         logger.info("🚀 Interfaz Mettler-Zebra iniciada correctamente")
         logger.info("📊 Estadísticas disponibles con 'stats' en modo interactivo")
         
         return True
     
-    def _start_mettler_with_callback(self):
-        """Inicia simulador Mettler con callback personalizado para procesar mensajes"""
-        
-        # Sobrescribir método send_weight_data para interceptar mensajes
-        original_send_weight_data = self.mettler_simulator.send_weight_data
-        
-        def custom_send_weight_data():
-            # Generar datos como siempre
-            data = self.mettler_simulator._generate_weight_data()
-            message = self.mettler_simulator._format_mettler_message(data)
-            
-            # Procesar mensaje con nuestro convertidor
-            self._process_mettler_message(message)
-            
-            # Mostrar mensaje original también
-            print(f"📊 METTLER: {message.strip()}")
-        
-        # Reemplazar método
-        self.mettler_simulator.send_weight_data = custom_send_weight_data
-        
-        # Iniciar simulación
-        self.mettler_simulator.start_simulation()
-    
     def _process_mettler_message(self, message: str):
         """Procesa mensaje de Mettler Toledo y lo envía a Zebra"""
         try:
-            self.stats['messages_received'] += 1
+            self._count('messages_received')
             
             # Convertir mensaje a ZPL
-            template = self.config['converter'].get('template', 'standard')
-            zpl_code = self.converter.convert_message(message, template)
+            zpl_code = self.converter.convert_message(message, self._template)
             
             if zpl_code:
                 # Enviar a impresora Zebra
                 self._send_to_zebra(zpl_code)
-                self.stats['labels_printed'] += 1
-                logger.info(f"✅ Etiqueta enviada a impresora Zebra")
+                logger.info("✅ Etiqueta encolada para impresora Zebra")
             else:
                 logger.debug("ℹ️  No se generó etiqueta (filtros aplicados)")
                 
         except Exception as e:
-            self.stats['errors'] += 1
+            self._count('errors')
             logger.error(f"❌ Error procesando mensaje Mettler: {e}")
     
+    def _connect_zebra(self) -> socket.socket:
+        """Abre conexión TCP persistente con la impresora Zebra"""
+        sock = socket.create_connection((self._zebra_ip, self._zebra_port), timeout=5.0)
+        
+        # Desactivar Nagle: las etiquetas ya se agrupan en _pending
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Buffer de envío amplio para que un lote de etiquetas no se fragmente
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+        
+        logger.debug("🔌 Conexión con impresora Zebra establecida")
+        return sock
+    
+    def _close_zebra(self):
+        """Cierra la conexión con la impresora Zebra"""
+        if self._zebra_sock:
+            try:
+                self._zebra_sock.close()
+            except OSError:
+                pass
+            self._zebra_sock = None
+    
     def _send_to_zebra(self, zpl_code: str):
-        """Envía código ZPL a la impresora Zebra"""
-        try:
-            import socket
+        """Encola código ZPL para el hilo de envío a la impresora Zebra"""
+        self._send_q.append(zpl_code.encode('utf-8'))
+        self._send_event.set()
+    
+    def _sender_loop(self):
+        """Consume la cola de etiquetas y las envía en lotes"""
+        stopping = False
+        while not stopping:
+            self._send_event.wait()
+            self._send_event.clear()
             
-            # Crear conexión TCP con la impresora simulada
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5.0)
+            # Agrupar todo lo encolado desde el último envío
+            while self._send_q:
+                payload = self._send_q.popleft()
+                if payload is None:
+                    stopping = True
+                    break
+                self._pending += payload
+                self._pending_labels += 1
             
-            zebra_config = self.config['zebra']
-            sock.connect((zebra_config['ip'], zebra_config['port']))
+            self._flush_pending()
+    
+    def _flush_pending(self):
+        """Envía todas las etiquetas acumuladas con un único sendall"""
+        if not self._pending:
+            return
+        
+        try:
+            if self._zebra_sock is not None:
+                # Detectar si la impresora cerró la conexión antes de escribir:
+                # tras el cierre, sendall aceptaría el lote y se perdería
+                try:
+                    self._drain_responses()
+                except OSError:
+                    self._close_zebra()
             
-            # Enviar ZPL
-            sock.send(zpl_code.encode('utf-8'))
+            if self._zebra_sock is None:
+                self._zebra_sock = self._connect_zebra()
             
-            # Leer respuesta si está disponible
             try:
-                response = sock.recv(1024).decode('utf-8')
-                if response:
-                    logger.debug(f"Respuesta Zebra: {response.strip()}")
-            except:
-                pass
+                self._zebra_sock.sendall(self._pending)
+            except (ConnectionResetError, BrokenPipeError):
+                # La impresora cerró la conexión: reconectar y reintentar una vez
+                logger.warning("⚠️  Conexión con Zebra perdida, reconectando...")
+                self._close_zebra()
+                self._zebra_sock = self._connect_zebra()
+                self._zebra_sock.sendall(self._pending)
+            
+            logger.debug("📤 ZPL enviado a impresora Zebra (%d bytes)", len(self._pending))
+            self._count('labels_printed', self._pending_labels)
+            self._pending.clear()
+            self._pending_labels = 0
             
-            sock.close()
-            logger.debug("📤 ZPL enviado a impresora Zebra")
+            # Leer respuestas disponibles sin bloquear el envío
+            self._drain_responses()
             
         except Exception as e:
+            # Las etiquetas del lote se descartan: cada una cuenta como error
+            self._count('errors', self._pending_labels)
+            self._pending.clear()
+            self._pending_labels = 0
+            self._close_zebra()
             logger.error(f"❌ Error enviando ZPL a Zebra: {e}")
-            raise
+    
+    def _drain_responses(self):
+        """Lee las respuestas pendientes de la impresora sin bloquear"""
+        while self._zebra_sock is not None:
+            readable, _, _ = select.select([self._zebra_sock], [], [], 0)
+            if not readable:
+                return
+            
+            response = self._zebra_sock.recv(4096)
+            if not response:
+                # La impresora cerró la conexión; se reabrirá en el próximo envío
+                self._close_zebra()
+                return
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Respuesta Zebra: %s", response.decode('utf-8', errors='ignore').strip())
     
     def stop_interface(self):
         """Detiene la interfaz"""
         self.is_running = False
+        self._stop_event.set()
         
         if self.mettler_simulator:
             self.mettler_simulator.stop_simulation()
         
+        # Enviar etiquetas pendientes y detener el hilo de envío
+        if self._sender_thread:
+            self._send_q.append(None)
+            self._send_event.set()
+            self._sender_thread.join()
+            self._sender_thread = None
+        
+        if self._zebra_sock:
+            try:
+                self._drain_responses()
+            except OSError:
+                pass
+        self._close_zebra()
+        
         if self.zebra_simulator:
             self.zebra_simulator.stop_server()
         
         logger.info("🛑 Interfaz detenida")
     
+    def wait_stopped(self, timeout: float = None) -> bool:
+        """Espera a que la interfaz se detenga; retorna True si se detuvo"""
+        return self._stop_event.wait(timeout)
+    
     def get_status(self) -> Dict[str, Any]:
         """Retorna estado completo del sistema"""
+        with self._stats_lock:
+            stats = self.stats.copy()
+        
         status = {
             'interface': {
                 'running': self.is_running,
                 'uptime': str(datetime.now() - self.stats['start_time']) if self.stats['start_time'] else None
             },
-            'stats': self.stats.copy(),
+            'stats': stats,
             'mettler': self.mettler_simulator.get_status() if self.mettler_simulator else None,
             'zebra': self.zebra_simulator.get_status() if self.zebra_simulator else None
         }
@@ -307,7 +447,7 @@ def main():
                         interface.print_status()
                     elif cmd == "stats":
                         stats = interface.get_status()['stats']
-                        print(json.dumps(stats, indent=2))
+                        print(_json_dumps_indented(stats))
                     elif cmd == "":
                         continue
                     else:
@@ -321,7 +461,9 @@ def main():
         else:
             # Modo automático
             duration = args.duration or 0
-            start_time = time.time()
+            status_interval = 30
+            start_time = time.monotonic()
+            next_status = start_time + status_interval
             
             print(f"🤖 Modo automático iniciado")
             if duration:
@@ -331,15 +473,23 @@ def main():
             
             try:
                 while interface.is_running:
-                    time.sleep(1)
+                    # Esperar hasta el próximo estado o el fin de la duración, en
+                    # tramos de 1 s para que Ctrl+C responda también en Windows
+                    now = time.monotonic()
+                    timeout = min(next_status - now, 1.0)
+                    if duration:
+                        remaining = start_time + duration - now
+                        if remaining <= 0:
+                            break
+                        timeout = min(timeout, remaining)
                     
-                    # Verificar duración
-                    if duration and (time.time() - start_time) >= duration:
+                    if interface.wait_stopped(timeout):
                         break
                     
                     # Mostrar estado cada 30 segundos
-                    if int(time.time() - start_time) % 30 == 0:
+                    if time.monotonic() >= next_status:
                         interface.print_status()
+                        next_status += status_interval
                         
             except KeyboardInterrupt:
                 print("\n🛑 Deteniendo por solicitud del usuario...")
@@ -10,9 +10,11 @@ import random
 import threading
 import json
 import logging
-from datetime import datetime
 from typing import Dict, Any, Optional
 
+# Checksum compartido con el convertidor
+from protocol_converter import mettler_checksum
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,11 +25,16 @@ class MettlerToledoSimulator:
     en el formato estándar de la marca
     """
     
+    # Plantillas de trama Mettler Toledo (STX = \x02, ETX = \x03)
+    _BODY_FMT = "WT,%08.1f,%s,%s,%s,%s,%s"
+    _FRAME_FMT = "\x02%s\x03%02X\r\n"
+    
     def __init__(self, port: str = 'COM1', baudrate: int = 9600, config_file: str = None):
         self.port = port
         self.baudrate = baudrate
         self.serial_connection = None
         self.is_running = False
+        self._stop_event = threading.Event()
         self.config = self._load_config(config_file)
         
         # Parámetros de simulación
@@ -35,6 +42,15 @@ class MettlerToledoSimulator:
         self.max_weight = self.config.get('max_weight', 10000.0)
         self.weight_interval = self.config.get('weight_interval', 2.0)  # segundos
         self.weight_tolerance = self.config.get('tolerance', 50.0)
+        self._product_codes = tuple(self.config.get('product_codes', ['PROD001']))
+        self._n_products = len(self._product_codes)
+        
+        # Generador aleatorio propio (semilla opcional para simulaciones reproducibles)
+        self._rng = random.Random(self.config.get('seed'))
+        
+        # Timestamp en caché (resolución de segundos)
+        self._ts_second = None
+        self._ts_text = ""
         
         # Estados de la balanza
         self.current_weight = 0.0
@@ -88,53 +104,53 @@ class MettlerToledoSimulator:
         target_weight = self.config.get('target_weight', 1000.0)
         
         # Simular variación natural del peso
-        variation = random.uniform(-100, 100)
+        variation = self._rng.uniform(-100, 100)
         self.current_weight = target_weight + variation
         
         # Determinar si está en tolerancia
         self.in_tolerance = abs(variation) <= self.weight_tolerance
         
         # Simular estabilidad (95% del tiempo estable)
-        self.is_stable = random.random() > 0.05
+        self.is_stable = self._rng.random() > 0.05
         
         return {
             'weight': self.current_weight,
             'unit': 'g',
             'stable': self.is_stable,
             'in_tolerance': self.in_tolerance,
-            'timestamp': datetime.now().isoformat(),
-            'product_code': random.choice(self.config.get('product_codes', ['PROD001']))
+            'timestamp': self._timestamp(),
+            'product_code': self._product_codes[self._rng.randrange(self._n_products)]
         }
     
+    def _timestamp(self) -> str:
+        """Retorna timestamp ISO 8601, formateado una sola vez por segundo"""
+        now = int(time.time())
+        if now != self._ts_second:
+            self._ts_second = now
+            self._ts_text = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(now))
+        return self._ts_text
+    
     def _format_mettler_message(self, data: Dict[str, Any]) -> str:
         """
         Formatea mensaje en protocolo Mettler Toledo
         Formato típico: STX + Datos + ETX + Checksum
         """
-        # Caracteres de control
-        STX = '\x02'  # Start of Text
-        ETX = '\x03'  # End of Text
-        
-        # Formatear peso con precisión
-        weight_str = f"{data['weight']:08.1f}"
-        
         # Status flags
         stable_flag = 'S' if data['stable'] else 'U'  # Stable/Unstable
         tolerance_flag = 'T' if data['in_tolerance'] else 'O'  # Tolerance/Out
         
-        # Construir mensaje
-        message_body = (
-            f"WT,{weight_str},{data['unit']},"
-            f"{stable_flag},{tolerance_flag},"
-            f"{data['product_code']},"
-            f"{data['timestamp']}"
+        # Construir mensaje con una sola operación de formato
+        message_body = self._BODY_FMT % (
+            data['weight'], data['unit'],
+            stable_flag, tolerance_flag,
+            data['product_code'], data['timestamp']
         )
         
         # Calcular checksum simple (suma de bytes mod 256)
-        checksum = sum(ord(c) for c in message_body) % 256
+        checksum = mettler_checksum(message_body)
         
-        # Mensaje completo
-        full_message = f"{STX}{message_body}{ETX}{checksum:02X}\r\n"
+        # Mensaje completo: STX + cuerpo + ETX + checksum + CRLF
+        full_message = self._FRAME_FMT % (message_body, checksum)
         
         return full_message
     
@@ -148,10 +164,9 @@ class MettlerToledoSimulator:
         message = self._format_mettler_message(data)
         
         try:
-            self.serial_connection.write(message.encode('ascii'))
-            logger.info(f"Enviado: Peso={data['weight']:.1f}g, "
-                       f"Estable={data['stable']}, "
-                       f"En tolerancia={data['in_tolerance']}")
+            self.serial_connection.write(message.encode('utf-8'))
+            logger.info("Enviado: Peso=%.1fg, Estable=%s, En tolerancia=%s",
+                        data['weight'], data['stable'], data['in_tolerance'])
         except Exception as e:
             logger.error(f"Error enviando datos: {e}")
     
@@ -165,11 +180,21 @@ class MettlerToledoSimulator:
             return
         
         self.is_running = True
+        self._stop_event.clear()
         
         def simulation_loop():
+            # Ticks a ritmo fijo: el tiempo de envío no acumula deriva
+            next_tick = time.monotonic()
             while self.is_running:
                 self.send_weight_data()
-                time.sleep(self.weight_interval)
+                next_tick += self.weight_interval
+                delay = next_tick - time.monotonic()
+                if delay < 0:
+                    # Vamos retrasados: no intentar recuperar ticks perdidos
+                    next_tick = time.monotonic()
+                    delay = 0
+                if self._stop_event.wait(delay):
+                    break
         
         self.simulation_thread = threading.Thread(target=simulation_loop)
         self.simulation_thread.start()
@@ -178,6 +203,7 @@ class MettlerToledoSimulator:
     def stop_simulation(self):
         """Detiene simulación"""
         self.is_running = False
+        self._stop_event.set()
         if hasattr(self, 'simulation_thread'):
             self.simulation_thread.join()
         self.disconnect()
@@ -212,9 +238,8 @@ class MettlerToledoSimulatorNoSerial(MettlerToledoSimulator):
         
         # En lugar de enviar por serial, imprimir en consola
         print(f"📊 METTLER DATA: {message.strip()}")
-        logger.info(f"Peso simulado: {data['weight']:.1f}g, "
-                   f"Estable: {data['stable']}, "
-                   f"En tolerancia: {data['in_tolerance']}")
+        logger.info("Peso simulado: %.1fg, Estable: %s, En tolerancia: %s",
+                    data['weight'], data['stable'], data['in_tolerance'])
 
 def main():
     """Función principal para pruebas"""
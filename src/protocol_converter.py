@@ -6,15 +6,47 @@ Convierte los datos del chequeador de pesos al formato ZPL para impresión
 
 import re
 import json
+import time
+import string
 import logging
+import functools
 from datetime import datetime
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 from dataclasses import dataclass
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Expresión regular para parsear mensajes Mettler Toledo
+_METTLER_RE = re.compile(
+    r'\x02WT,([0-9.+-]+),(\w+),([SU]),([TO]),([^,]+),([^,]+)\x03([0-9A-F]{2})',
+    re.ASCII
+)
+_STX_WT = '\x02WT,'
+_MAX_FRAME_LEN = 128  # Las tramas reales ocupan ~50-80 bytes entre STX y ETX
+
+def mettler_checksum(body: str) -> int:
+    """Checksum Mettler Toledo: suma de los bytes UTF-8 del cuerpo (entre STX y ETX) mod 256"""
+    return sum(body.encode('utf-8')) & 0xFF
+
+@functools.lru_cache(maxsize=1024)
+def _format_timestamp(timestamp: str) -> str:
+    """Convierte timestamp ISO 8601 al formato de etiqueta (dd/mm/aaaa hh:mm:ss)"""
+    try:
+        dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        return dt.strftime('%d/%m/%Y %H:%M:%S')
+    except ValueError:
+        return timestamp
+
+def _format_field(value: Any, conversion: Optional[str], format_spec: str) -> str:
+    """Aplica conversión (!r, !a) y formato a un campo de plantilla"""
+    if conversion == "r":
+        value = repr(value)
+    elif conversion == "a":
+        value = ascii(value)
+    return format(value, format_spec)
+
 @dataclass
 class WeightData:
     """Estructura de datos de peso procesados"""
@@ -36,6 +68,12 @@ class LabelData:
     status: str
     batch_number: str = ""
     line_number: str = "LINE01"
+    tolerance_label: str = ""
+    
+    def __post_init__(self):
+        """Deriva la etiqueta de tolerancia del estado si no se indicó"""
+        if not self.tolerance_label:
+            self.tolerance_label = 'FUERA' if self.status == 'RECHAZADO' else 'OK'
 
 class ProtocolConverter:
     """
@@ -44,12 +82,19 @@ class ProtocolConverter:
     
     def __init__(self, config_file: str = None):
         self.config = self._load_config(config_file)
-        self.label_templates = self._load_label_templates()
+        self.label_templates = {
+            name: tpl.strip() for name, tpl in self._load_label_templates().items()
+        }
+        self._compiled_templates = {
+            name: self._compile_template(tpl) for name, tpl in self.label_templates.items()
+        }
         
-        # Expresión regular para parsear mensajes Mettler Toledo
-        self.mettler_pattern = re.compile(
-            r'\x02WT,([0-9.+-]+),(\w+),([SU]),([TO]),([^,]+),([^,]+)\x03([0-9A-F]{2})'
-        )
+        # Caché de etiquetas renderizadas (todos los campos salvo el timestamp)
+        self._render_static_cached = functools.lru_cache(maxsize=512)(self._render_static)
+        
+        # Número de lote en caché (cambia una vez por minuto)
+        self._batch_minute = None
+        self._batch_number = ""
     
     def _load_config(self, config_file: str) -> Dict[str, Any]:
         """Carga configuración desde archivo JSON"""
@@ -64,6 +109,7 @@ class ProtocolConverter:
             "weight_threshold": 50.0,
             "print_on_out_of_tolerance": True,
             "print_on_stable_only": False,
+            "validate_checksum": True,
             "label_width": 4,  # pulgadas
             "label_height": 3,  # pulgadas
             "dpi": 203  # dots per inch
@@ -105,7 +151,7 @@ class ProtocolConverter:
 ^FO30,120^FDPeso: {weight} {unit}^FS
 ^CF0,25
 ^FO30,180^FDEstado: {status}^FS
-^FO30,210^FDTolerancia: {'OK' if status == 'APROBADO' else 'FUERA'}^FS
+^FO30,210^FDTolerancia: {tolerance_label}^FS
 ^FO30,240^FDFecha: {timestamp}^FS
 ^FO30,270^FDLínea: {line_number}^FS
 ^FO30,300^FDLote: {batch_number}^FS
@@ -115,6 +161,23 @@ class ProtocolConverter:
 """
         }
     
+    @staticmethod
+    def _compile_template(zpl_template: str) -> List[Tuple[str, Optional[str], Optional[str], str]]:
+        """
+        Pre-analiza una plantilla en segmentos (literal, campo, conversión, formato)
+        para no volver a interpretar la cadena de formato en cada etiqueta
+        """
+        segments = []
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(zpl_template):
+            if field_name is not None:
+                # Solo nombres simples: sin índices, atributos ni formatos anidados
+                if not field_name.isidentifier():
+                    raise ValueError(f"Campo de plantilla no soportado: '{field_name}'")
+                if format_spec and '{' in format_spec:
+                    raise ValueError(f"Formato anidado no soportado en campo '{field_name}'")
+            segments.append((literal, field_name, conversion, format_spec or ""))
+        return segments
+    
     def parse_mettler_message(self, message: str) -> Optional[WeightData]:
         """
         Parsea mensaje de Mettler Toledo y extrae datos de peso
@@ -122,19 +185,35 @@ class ProtocolConverter:
         Formato esperado: STX + WT,peso,unidad,estable,tolerancia,código,timestamp + ETX + checksum
         """
         try:
-            # Limpiar mensaje
-            clean_message = message.strip()
+            # Delimitar cada trama STX...ETX antes de aplicar la expresión regular;
+            # si una trama está truncada o es ruido, probar con el siguiente STX
+            match = None
+            stx = message.find(_STX_WT)
+            while stx >= 0:
+                etx = message.find('\x03', stx)
+                if etx < 0:
+                    break
+                if etx - stx > _MAX_FRAME_LEN:
+                    logger.warning(f"Trama demasiado larga ({etx - stx} bytes), descartada")
+                else:
+                    match = _METTLER_RE.match(message, stx, etx + 3)
+                    if match:
+                        break
+                stx = message.find(_STX_WT, stx + 1)
             
-            # Buscar patrón
-            match = self.mettler_pattern.search(clean_message)
             if not match:
-                logger.warning(f"Mensaje no reconocido: {clean_message}")
+                logger.warning(f"Mensaje no reconocido: {message.strip()}")
                 return None
             
             weight_str, unit, stable_flag, tolerance_flag, product_code, timestamp, checksum = match.groups()
             
-            # Validar checksum (opcional)
-            # TODO: Implementar validación de checksum si es necesario
+            # Validar checksum: suma de bytes entre STX y ETX mod 256
+            if self.config.get("validate_checksum", True):
+                expected = mettler_checksum(message[stx + 1:etx])
+                if int(checksum, 16) != expected:
+                    logger.warning(f"Checksum inválido ({checksum}, esperado {expected:02X}): "
+                                   f"{message.strip()}")
+                    return None
             
             # Convertir datos
             weight = float(weight_str)
@@ -148,7 +227,7 @@ class ProtocolConverter:
                 in_tolerance=in_tolerance,
                 product_code=product_code,
                 timestamp=timestamp,
-                original_message=clean_message
+                original_message=match.group(0)
             )
             
         except Exception as e:
@@ -174,6 +253,14 @@ class ProtocolConverter:
         
         return True
     
+    def _current_batch_number(self) -> str:
+        """Retorna número de lote del minuto actual, formateado una vez por minuto"""
+        minute = int(time.time() // 60)
+        if minute != self._batch_minute:
+            self._batch_minute = minute
+            self._batch_number = "B" + time.strftime('%Y%m%d%H%M', time.localtime(minute * 60))
+        return self._batch_number
+    
     def create_label_data(self, weight_data: WeightData) -> LabelData:
         """
         Convierte datos de peso a estructura de etiqueta
@@ -187,14 +274,10 @@ class ProtocolConverter:
             status = "INESTABLE"
         
         # Generar número de lote (ejemplo)
-        batch_number = f"B{datetime.now().strftime('%Y%m%d%H%M')}"
+        batch_number = self._current_batch_number()
         
         # Formatear timestamp
-        try:
-            dt = datetime.fromisoformat(weight_data.timestamp.replace('Z', '+00:00'))
-            formatted_time = dt.strftime('%d/%m/%Y %H:%M:%S')
-        except:
-            formatted_time = weight_data.timestamp
+        formatted_time = _format_timestamp(weight_data.timestamp)
         
         return LabelData(
             weight=weight_data.weight,
@@ -206,28 +289,68 @@ class ProtocolConverter:
             line_number=self.config.get("line_number", "LINE01")
         )
     
+    def _render_static(self, template: str, weight: str, unit: str, product_code: str,
+                       status: str, batch_number: str, line_number: str, tolerance_label: str
+                       ) -> Tuple[Tuple[str, ...], Tuple[Tuple[Optional[str], str], ...]]:
+        """
+        Renderiza los campos fijos de la plantilla. Retorna los trozos de texto
+        separados por los huecos de timestamp y el formato de cada hueco
+        """
+        values = {
+            "weight": weight,
+            "unit": unit,
+            "product_code": product_code,
+            "status": status,
+            "batch_number": batch_number,
+            "line_number": line_number,
+            "tolerance_label": tolerance_label
+        }
+        
+        chunks = []
+        slots = []
+        parts = []
+        for literal, field_name, conversion, format_spec in self._compiled_templates[template]:
+            parts.append(literal)
+            if field_name is None:
+                continue
+            if field_name == "timestamp":
+                # El timestamp cambia en cada mensaje: se deja un hueco
+                chunks.append("".join(parts))
+                slots.append((conversion, format_spec))
+                parts = []
+            else:
+                parts.append(_format_field(values[field_name], conversion, format_spec))
+        chunks.append("".join(parts))
+        
+        return tuple(chunks), tuple(slots)
+    
     def generate_zpl(self, label_data: LabelData, template: str = "standard") -> str:
         """
         Genera código ZPL para la etiqueta
         """
-        if template not in self.label_templates:
+        if template not in self._compiled_templates:
             logger.warning(f"Plantilla '{template}' no encontrada, usando 'standard'")
             template = "standard"
         
-        zpl_template = self.label_templates[template]
-        
         try:
-            zpl_code = zpl_template.format(
-                weight=f"{label_data.weight:.1f}",
-                unit=label_data.unit,
-                product_code=label_data.product_code,
-                timestamp=label_data.timestamp,
-                status=label_data.status,
-                batch_number=label_data.batch_number,
-                line_number=label_data.line_number
+            chunks, slots = self._render_static_cached(
+                template,
+                f"{label_data.weight:.1f}",
+                label_data.unit,
+                label_data.product_code,
+                label_data.status,
+                label_data.batch_number,
+                label_data.line_number,
+                label_data.tolerance_label
             )
             
-            return zpl_code.strip()
+            # Completar los huecos de timestamp
+            parts = [chunks[0]]
+            for (conversion, format_spec), chunk in zip(slots, chunks[1:]):
+                parts.append(_format_field(label_data.timestamp, conversion, format_spec))
+                parts.append(chunk)
+            
+            return "".join(parts)
             
         except Exception as e:
             logger.error(f"Error generando ZPL: {e}")
@@ -265,7 +388,11 @@ class ProtocolConverter:
     
     def add_custom_template(self, name: str, zpl_template: str):
         """Añade plantilla personalizada"""
+        zpl_template = zpl_template.strip()
+        compiled = self._compile_template(zpl_template)
         self.label_templates[name] = zpl_template
+        self._compiled_templates[name] = compiled
+        self._render_static_cached.cache_clear()
         logger.info(f"Plantilla '{name}' añadida")
 
 # Utilidades adicionales
@@ -320,9 +447,9 @@ def main():
     if args.test:
         # Datos de prueba
         test_messages = [
-            "\x02WT,01250.5,g,S,T,PROD001,2024-08-25T10:30:15\x0341\r\n",
-            "\x02WT,00950.2,g,S,O,PROD002,2024-08-25T10:31:20\x0342\r\n",
-            "\x02WT,01100.8,g,U,T,PROD003,2024-08-25T10:32:25\x0343\r\n"
+            "\x02WT,01250.5,g,S,T,PROD001,2024-08-25T10:30:15\x03C5\r\n",
+            "\x02WT,00950.2,g,S,O,PROD002,2024-08-25T10:31:20\x03C1\r\n",
+            "\x02WT,01100.8,g,U,T,PROD003,2024-08-25T10:32:25\x03C9\r\n"
         ]
         
         print(f"🔄 Convertidor iniciado con plantilla '{args.template}'")
@@ -5,20 +5,50 @@ Simula el comportamiento de una impresora Zebra que recibe comandos ZPL
 """
 
 import socket
+import selectors
 import threading
 import time
 import logging
 import json
 import re
+from collections import deque
 from datetime import datetime
-from typing import Dict, Any, Optional, List
-from dataclasses import dataclass
+from typing import Dict, Any, Optional, Deque
+from dataclasses import dataclass, field
 from io import StringIO
 
+try:
+    import orjson  # Opcional: respuestas ~HS/~JQ más rápidas
+except ImportError:
+    orjson = None
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Expresiones regulares para analizar ZPL
+_PQ_RE = re.compile(r'\^PQ(\d+)', re.ASCII)
+_FD_RE = re.compile(r'\^FD([^\^]+)\^FS', re.ASCII)
+_BARCODE_RE = re.compile(r'\^B[C3]\^FD([^\^]+)\^FS', re.ASCII)
+
+# Máximo de respuestas sin leer por cliente antes de cerrar la conexión
+_MAX_OUTBOUND = 1 << 20
+
+# Palabras clave (español, inglés) para identificar campos de la etiqueta, por prioridad
+_FIELD_NAMES = (
+    (('producto', 'product'), 'Producto'),
+    (('peso', 'weight'), 'Peso'),
+    (('fecha', 'date'), 'Fecha'),
+    (('estado', 'status'), 'Estado'),
+    (('lote', 'batch'), 'Lote'),
+)
+
+def _json_dumps_compact(data: Any) -> bytes:
+    """Serializa a JSON compacto en bytes; orjson y json producen los mismos bytes"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
 @dataclass
 class PrintJob:
     """Estructura para trabajos de impresión"""
@@ -27,6 +57,7 @@ class PrintJob:
     timestamp: str
     status: str = "pending"  # pending, printing, completed, error
     copies: int = 1
+    queue_entry: bytes = field(default=b"", repr=False)  # JSON para ~JQ, generado al encolar
 
 class ZebraSimulator:
     """
@@ -46,12 +77,14 @@ class ZebraSimulator:
         self.temperature = 25         # grados Celsius
         
         # Cola de impresión
-        self.print_queue: List[PrintJob] = []
+        self.print_queue: Deque[PrintJob] = deque()
+        self._queue_evt = threading.Event()
         self.job_counter = 0
         
         # Socket servidor
         self.server_socket = None
-        self.client_threads = []
+        self._selector = None
+        self._server_thread = None
         
         # Estadísticas
         self.total_jobs = 0
@@ -76,7 +109,8 @@ class ZebraSimulator:
             "darkness": 10,    # 0-30
             "simulation_delay": 2.0,  # segundos por etiqueta
             "enable_status_response": True,
-            "auto_print": True
+            "auto_print": True,
+            "verbose_simulation": True  # False: sin salida por consola (pruebas de carga)
         }
     
     def start_server(self) -> bool:
@@ -89,10 +123,12 @@ class ZebraSimulator:
             
             self.is_running = True
             
-            # Hilo para aceptar conexiones
-            accept_thread = threading.Thread(target=self._accept_connections)
-            accept_thread.daemon = True
-            accept_thread.start()
+            # Hilo único que atiende todas las conexiones
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self.server_socket, selectors.EVENT_READ)
+            self._server_thread = threading.Thread(target=self._serve_connections)
+            self._server_thread.daemon = True
+            self._server_thread.start()
             
             # Hilo para procesar cola de impresión
             print_thread = threading.Thread(target=self._process_print_queue)
@@ -110,76 +146,107 @@ class ZebraSimulator:
     def stop_server(self):
         """Detiene el servidor"""
         self.is_running = False
+        self._queue_evt.set()
+        
+        # El hilo de conexiones cierra los clientes al salir
+        if self._server_thread:
+            self._server_thread.join(timeout=1)
         
         if self.server_socket:
             self.server_socket.close()
         
-        # Cerrar conexiones de clientes
-        for thread in self.client_threads:
-            thread.join(timeout=1)
-        
         logger.info("🛑 Simulador Zebra detenido")
     
-    def _accept_connections(self):
-        """Acepta conexiones TCP entrantes"""
-        while self.is_running:
-            try:
-                client_socket, address = self.server_socket.accept()
-                logger.info(f"📡 Nueva conexión desde {address}")
-                
-                # Crear hilo para manejar cliente
-                client_thread = threading.Thread(
-                    target=self._handle_client,
-                    args=(client_socket, address)
-                )
-                client_thread.daemon = True
-                client_thread.start()
-                
-                self.client_threads.append(client_thread)
-                
-            except Exception as e:
-                if self.is_running:
-                    logger.error(f"Error aceptando conexión: {e}")
+    def _serve_connections(self):
+        """Atiende conexiones entrantes y datos de clientes en un solo hilo"""
+        try:
+            while self.is_running:
+                for key, mask in self._selector.select(timeout=0.5):
+                    if key.data is None:
+                        self._accept_connection()
+                        continue
+                    if mask & selectors.EVENT_WRITE and not self._write_client(key):
+                        continue  # Cliente cerrado
+                    if mask & selectors.EVENT_READ:
+                        self._read_client(key.fileobj, *key.data[:2])
+        finally:
+            # Cerrar conexiones de clientes
+            for key in list(self._selector.get_map().values()):
+                if key.data is not None:
+                    self._close_client(key.fileobj, key.data[0])
+            self._selector.close()
+    
+    def _accept_connection(self):
+        """Acepta una conexión TCP entrante"""
+        try:
+            client_socket, address = self.server_socket.accept()
+        except OSError as e:
+            if self.is_running:
+                logger.error(f"Error aceptando conexión: {e}")
+            return
+        
+        logger.info(f"📡 Nueva conexión desde {address}")
+        # No bloqueante: un cliente lento no debe detener al resto
+        client_socket.setblocking(False)
+        self._selector.register(client_socket, selectors.EVENT_READ,
+                                (address, bytearray(), bytearray()))
+    
+    def _close_client(self, client_socket: socket.socket, address):
+        """Cierra la conexión con un cliente"""
+        if client_socket.fileno() < 0:
+            return  # Ya cerrado
+        self._selector.unregister(client_socket)
+        client_socket.close()
+        logger.info(f"🔌 Conexión cerrada con {address}")
     
-    def _handle_client(self, client_socket: socket.socket, address):
-        """Maneja comunicación con un cliente"""
+    def _read_client(self, client_socket: socket.socket, address, buffer: bytearray):
+        """Lee datos disponibles de un cliente y procesa los comandos completos"""
         try:
-            buffer = ""
+            data = client_socket.recv(16384)
+            if not data:
+                self._close_client(client_socket, address)
+                return
             
-            while self.is_running:
-                data = client_socket.recv(1024)
-                if not data:
-                    break
-                
-                # Decodificar datos
-                received = data.decode('utf-8', errors='ignore')
-                buffer += received
-                
-                # Procesar comandos ZPL completos
-                while '^XA' in buffer and '^XZ' in buffer:
-                    start = buffer.find('^XA')
-                    end = buffer.find('^XZ', start) + 3
-                    
-                    if end > start:
-                        zpl_command = buffer[start:end]
-                        buffer = buffer[end:]
-                        
-                        # Procesar comando ZPL
-                        self._process_zpl_command(zpl_command, client_socket)
-                
-                # Procesar otros comandos (status, configuración, etc.)
-                lines = buffer.split('\n')
-                for line in lines[:-1]:  # Procesar todas las líneas completas
-                    if line.strip():
-                        self._process_other_command(line.strip(), client_socket)
-                
-                buffer = lines[-1]  # Mantener línea incompleta
-                
+            buffer.extend(data)
+            self._process_buffer(buffer, client_socket)
+            
+        except BlockingIOError:
+            pass
         except Exception as e:
             logger.error(f"Error manejando cliente {address}: {e}")
-        finally:
-            client_socket.close()
-            logger.info(f"🔌 Conexión cerrada con {address}")
+            self._close_client(client_socket, address)
+    
+    def _process_buffer(self, buffer: bytearray, client_socket: socket.socket):
+        """Extrae y procesa los comandos completos del buffer de un cliente"""
+        while True:
+            start = buffer.find(b'^XA')
+            if start < 0:
+                # Procesar otros comandos (status, configuración, etc.)
+                nl = buffer.rfind(b'\n')
+                if nl >= 0:
+                    self._process_command_lines(bytes(buffer[:nl]), client_socket)
+                    del buffer[:nl + 1]  # Mantener línea incompleta
+                return
+            
+            # Comandos recibidos antes del inicio de la etiqueta
+            if start > 0:
+                self._process_command_lines(bytes(buffer[:start]), client_socket)
+                del buffer[:start]
+            
+            end = buffer.find(b'^XZ', 3)
+            if end < 0:
+                return  # Etiqueta incompleta: esperar más datos
+            
+            # Procesar comando ZPL completo
+            zpl_command = bytes(buffer[:end + 3]).decode('utf-8', errors='ignore')
+            del buffer[:end + 3]
+            self._process_zpl_command(zpl_command, client_socket)
+    
+    def _process_command_lines(self, data: bytes, client_socket: socket.socket):
+        """Procesa comandos de una línea (status, configuración)"""
+        for line in data.decode('utf-8', errors='ignore').split('\n'):
+            if line.strip():
+                self._process_other_command(line.strip(), client_socket)
     
     def _process_zpl_command(self, zpl_code: str, client_socket: socket.socket):
         """Procesa comando ZPL para impresión"""
@@ -194,8 +261,16 @@ class ZebraSimulator:
             copies=self._extract_copies_from_zpl(zpl_code)
         )
         
+        job.queue_entry = _json_dumps_compact({
+            "job_id": job.job_id,
+            "status": job.status,
+            "timestamp": job.timestamp,
+            "copies": job.copies
+        })
+        
         # Agregar a cola
         self.print_queue.append(job)
+        self._queue_evt.set()
         self.total_jobs += 1
         
         logger.info(f"🆔 Trabajo {job.job_id} agregado a la cola")
@@ -203,10 +278,38 @@ class ZebraSimulator:
         # Enviar respuesta si está habilitada
         if self.config.get("enable_status_response", True):
             response = f"JOB {job.job_id} QUEUED\n"
-            try:
-                client_socket.send(response.encode('utf-8'))
-            except:
-                pass
+            self._send(client_socket, response.encode('utf-8'))
+    
+    def _send(self, client_socket: socket.socket, payload: bytes):
+        """Agrega una respuesta al buffer de salida del cliente y lo envía cuando sea posible"""
+        if client_socket.fileno() < 0:
+            return  # Cliente cerrado mientras se procesaba su buffer
+        key = self._selector.get_key(client_socket)
+        outbuf = key.data[2]
+        if len(outbuf) + len(payload) > _MAX_OUTBOUND:
+            raise ConnectionError("el cliente no lee sus respuestas")
+        outbuf.extend(payload)
+        self._write_client(key)
+    
+    def _write_client(self, key: selectors.SelectorKey) -> bool:
+        """Envía lo posible del buffer de salida; retorna False si se cerró el cliente"""
+        client_socket = key.fileobj
+        address, _, outbuf = key.data
+        try:
+            sent = client_socket.send(outbuf)
+            del outbuf[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            # Conexión perdida: descartar respuestas pendientes
+            self._close_client(client_socket, address)
+            return False
+        
+        # Esperar a que el socket admita escritura solo mientras queden datos
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if outbuf else 0)
+        if key.events != events:
+            self._selector.modify(client_socket, events, key.data)
+        return True
     
     def _process_other_command(self, command: str, client_socket: socket.socket):
         """Procesa otros comandos (status, configuración)"""
@@ -238,33 +341,21 @@ class ZebraSimulator:
             "failed_jobs": self.failed_jobs
         }
         
-        response = f"STATUS: {json.dumps(status)}\n"
-        try:
-            client_socket.send(response.encode('utf-8'))
-        except:
-            pass
+        self._send(client_socket, b"STATUS: " + _json_dumps_compact(status) + b"\n")
     
     def _send_queue_status(self, client_socket: socket.socket):
         """Envía estado de la cola"""
-        queue_info = []
-        for job in self.print_queue:
-            queue_info.append({
-                "job_id": job.job_id,
-                "status": job.status,
-                "timestamp": job.timestamp,
-                "copies": job.copies
-            })
-        
-        response = f"QUEUE: {json.dumps(queue_info)}\n"
-        try:
-            client_socket.send(response.encode('utf-8'))
-        except:
-            pass
+        # Los trabajos en cola siguen pendientes: su JSON no cambia desde que se encolaron
+        entries = b",".join([job.queue_entry for job in list(self.print_queue)])
+        self._send(client_socket, b"QUEUE: [" + entries + b"]\n")
     
     def _extract_copies_from_zpl(self, zpl_code: str) -> int:
         """Extrae número de copias del código ZPL"""
         # Buscar comando ^PQ (Print Quantity)
-        match = re.search(r'\^PQ(\d+)', zpl_code)
+        if '^PQ' not in zpl_code:
+            return 1
+        
+        match = _PQ_RE.search(zpl_code)
         if match:
             return int(match.group(1))
         return 1
@@ -272,11 +363,17 @@ class ZebraSimulator:
     def _process_print_queue(self):
         """Procesa la cola de impresión"""
         while self.is_running:
-            if self.print_queue and self.is_online:
-                job = self.print_queue.pop(0)
-                self._simulate_printing(job)
-            else:
-                time.sleep(0.1)
+            if not (self.print_queue and self.is_online):
+                # Esperar a un nuevo trabajo o a un cambio de estado
+                self._queue_evt.wait(timeout=0.5)
+                self._queue_evt.clear()
+                continue
+            
+            try:
+                job = self.print_queue.popleft()
+            except IndexError:
+                continue  # Cola vaciada mientras tanto
+            self._simulate_printing(job)
     
     def _simulate_printing(self, job: PrintJob):
         """Simula el proceso de impresión"""
@@ -287,67 +384,73 @@ class ZebraSimulator:
         print_time = self.config.get("simulation_delay", 2.0)
         
         try:
-            # Analizar ZPL para obtener información
-            zpl_info = self._analyze_zpl(job.zpl_code)
-            
-            # Mostrar contenido de la etiqueta
-            print("\n" + "="*60)
-            print(f"🏷️  IMPRIMIENDO ETIQUETA - {job.job_id}")
-            print("="*60)
-            
-            if zpl_info:
-                for key, value in zpl_info.items():
-                    print(f"{key}: {value}")
-            
-            print(f"📋 Copias: {job.copies}")
-            print(f"⏱️  Tiempo estimado: {print_time:.1f}s")
-            print("="*60)
-            
-            # Simular progreso de impresión
-            for i in range(int(print_time * 10)):
-                if not self.is_running:
-                    break
-                time.sleep(0.1)
-                if i % 10 == 0:  # Cada segundo
-                    progress = (i / (print_time * 10)) * 100
-                    print(f"📊 Progreso: {progress:.0f}%")
+            if self.config.get("verbose_simulation", True):
+                self._print_job_progress(job, print_time)
+            else:
+                logger.debug("Imprimiendo %s (%d copias, %.1fs)", job.job_id, job.copies, print_time)
+                time.sleep(print_time)
             
             # Marcar como completado
             job.status = "completed"
             self.successful_jobs += 1
             
-            print(f"✅ Impresión {job.job_id} completada")
-            print("\n")
-            
         except Exception as e:
             job.status = "error"
             self.failed_jobs += 1
             logger.error(f"❌ Error imprimiendo {job.job_id}: {e}")
     
+    def _print_job_progress(self, job: PrintJob, print_time: float):
+        """Muestra en consola el contenido y el progreso de un trabajo"""
+        # Analizar ZPL para obtener información
+        zpl_info = self._analyze_zpl(job.zpl_code)
+        
+        # Mostrar contenido de la etiqueta
+        print("\n" + "="*60)
+        print(f"🏷️  IMPRIMIENDO ETIQUETA - {job.job_id}")
+        print("="*60)
+        
+        if zpl_info:
+            for key, value in zpl_info.items():
+                print(f"{key}: {value}")
+        
+        print(f"📋 Copias: {job.copies}")
+        print(f"⏱️  Tiempo estimado: {print_time:.1f}s")
+        print("="*60)
+        
+        # Simular progreso de impresión
+        for i in range(int(print_time * 10)):
+            if not self.is_running:
+                break
+            time.sleep(0.1)
+            if i % 10 == 0:  # Cada segundo
+                progress = (i / (print_time * 10)) * 100
+                print(f"📊 Progreso: {progress:.0f}%")
+        
+        print(f"✅ Impresión {job.job_id} completada")
+        print("\n")
+    
     def _analyze_zpl(self, zpl_code: str) -> Dict[str, str]:
         """Analiza código ZPL para extraer información"""
         info = {}
         
+        if '^FD' not in zpl_code:
+            return info
+        
         # Buscar campos de texto (^FD...^FS)
-        text_fields = re.findall(r'\^FD([^\^]+)\^FS', zpl_code)
+        text_fields = _FD_RE.findall(zpl_code)
         
         # Intentar identificar campos comunes
         for i, text in enumerate(text_fields):
-            if 'producto' in text.lower() or 'product' in text.lower():
-                info['Producto'] = text
-            elif 'peso' in text.lower() or 'weight' in text.lower():
-                info['Peso'] = text
-            elif 'fecha' in text.lower() or 'date' in text.lower():
-                info['Fecha'] = text
-            elif 'estado' in text.lower() or 'status' in text.lower():
-                info['Estado'] = text
-            elif 'lote' in text.lower() or 'batch' in text.lower():
-                info['Lote'] = text
+            text_lower = text.lower()
+            for keywords, name in _FIELD_NAMES:
+                if any(keyword in text_lower for keyword in keywords):
+                    info[name] = text
+                    break
             else:
                 info[f'Campo {i+1}'] = text
         
         # Buscar códigos de barras (^BC, ^B3, etc.)
-        barcode_match = re.search(r'\^B[C3]\^FD([^\^]+)\^FS', zpl_code)
+        barcode_match = _BARCODE_RE.search(zpl_code)
         if barcode_match:
             info['Código de Barras'] = barcode_match.group(1)
         
@@ -374,6 +477,7 @@ class ZebraSimulator:
         """Cambia estado de la impresora para simular problemas"""
         if online is not None:
             self.is_online = online
+            self._queue_evt.set()
             logger.info(f"🔧 Impresora {'online' if online else 'offline'}")
         
         if paper is not None:
@@ -433,7 +537,7 @@ def main():
                         simulator.set_printer_status(ribbon=ribbon_status)
                     elif cmd == "queue":
                         print(f"Cola: {len(simulator.print_queue)} trabajos pendientes")
-                        for job in simulator.print_queue:
+                        for job in list(simulator.print_queue):
                             print(f"  {job.job_id}: {job.status}")
                     elif cmd == "clear":
                         simulator.print_queue.clear()